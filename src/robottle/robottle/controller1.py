@@ -1,8 +1,16 @@
 import rclpy
 from rclpy.node import Node
+from rclpy.qos import QoSProfile, QoSHistoryPolicy, QoSReliabilityPolicy
+from rclpy.callback_groups import MutuallyExclusiveCallbackGroup, ReentrantCallbackGroup
+from rclpy.executors import MultiThreadedExecutor
+from rclpy.logging import LoggingSeverity
 import numpy as np
 import time
 import sys
+import math
+import queue
+import threading
+from enum import IntEnum
 
 from vision_msgs.msg import Detection2DArray
 from interfaces.msg import Map, Position, Status, LidarData
@@ -11,30 +19,48 @@ from std_msgs.msg import String
 from robottle_utils import map_utils, controller_utils, vision_utils, lidar_utils
 from robottle_utils.vizualiser import ImageVizualiser
 from robottle_utils.rrt_star import RRTStar
+from robottle.uart_writer import COMMANDS, COMMANDS_QOS, open_serial_port, UARTWriter
 
 ### STATE MACHINES
 
-INITIAL_ROTATION_MODE = "initial_rotation_mode"
-TRAVEL_MODE = "travel_mode"
-RANDOM_SEARCH_MODE = "random_search_mode"
-BOTTLE_PICKING_MODE = "bottle_picking_mode"
-BOTTLE_RELEASE_MODE = "bottle_release_mode"
-BOTTLE_REACHING_MODE = "bottle_reaching_mode"
-KICK_ASS_MODE = "rocks_will_die"
-RECOVERY_SLAM = "recovery_mode"
-RECOVERY_ROTATION = "recovery_rotation"
-
-TIMER_STATE_OFF = "0"
-TIMER_STATE_ON_TRAVEL_MODE = "1"
-TIMER_STATE_ON_RANDOM_SEARCH_BOTTLE_ALIGNMENT = "2"
-TIMER_STATE_ON_RANDOM_SEARCH_DELTA_ROTATION = "3"
-TIMER_STATE_ON_BOTTLE_RELEASE = "4"
-TIMER_STATE_ON_NO_ROTATION = "5"
-TIMER_STATE_ON_KICK_ASS_MODE = "6"
-TIMER_STATE_ON_TRAVEL_MODE_END = "7"
-
-DETECTNET_ON = "ON"
-DETECTNET_OFF = "OFF"
+class State(IntEnum):
+    """States of the controller"""
+    INITIAL_ROTATION = 0
+    TRAVEL = 1
+    RANDOM_SEARCH = 2
+    BOTTLE_PICKING = 3
+    BOTTLE_RELEASE = 4
+    BOTTLE_REACHING = 5
+    KICK_ASS = 6
+    RECOVERY_SLAM = 7
+    RECOVERY_ROTATION = 8
+
+class TimerState(IntEnum):
+    """What has to be done when the rotation timer fires"""
+    OFF = 0
+    TRAVEL_MODE = 1
+    RANDOM_SEARCH_BOTTLE_ALIGNMENT = 2
+    RANDOM_SEARCH_DELTA_ROTATION = 3
+    BOTTLE_RELEASE = 4
+    NO_ROTATION = 5
+    KICK_ASS_MODE = 6
+    TRAVEL_MODE_END = 7
+
+class RotationState:
+    """Bookkeeping of the last rotation asked to the robot"""
+    __slots__ = ("state", "theta", "angle", "index", "deadline")
+
+    def __init__(self):
+        # what to do when the rotation is finished
+        self.state = TimerState.OFF
+        # orientation of the robot when the rotation started
+        self.theta = 0
+        # angle of the rotation
+        self.angle = 0
+        # number of rotations asked so far
+        self.index = 0
+        # time (time.monotonic) at which the rotation is finished
+        self.deadline = 0
 
 ### HYPERPARAMETERS
 
@@ -46,8 +72,10 @@ MIN_DIST_TO_GOAL = 25 # [pixels]
 MIN_DIST_TO_RECYCLING = 12
 # min distance between robot and point in the path to consider the robot as passed it
 MIN_DIST_TO_POINT = 0.2 # [m]
-# time constant of path computation update (the bigger, the less often the path is updated)
-CONTROLLER_TIME_CONSTANT = 30
+# distance travelled by the robot since the last path computation after which the path is updated
+REPLAN_DISTANCE = 40 # [pixels]
+# maximum age of the path before it is updated
+REPLAN_MAX_AGE = 5 # [s]
 # path-tracker min angle diff for directing the robot
 MIN_ANGLE_DIFF = 15 # [deg]
 # Array containing indices of zones to visit: note that zones = [r, z2, z3, z4]
@@ -62,6 +90,23 @@ MAX_BOTTLE_PICKED = 5
 # maximum number of times controller enters random search mode inside 1 zone
 N_RANDOM_SEARCH_MAX = 11
 
+# time required to rotate of each angle (from 0 to 180 degrees, with a 1 degree step)
+ROTATION_TIMES = tuple(controller_utils.get_rotation_time(a) for a in range(181))
+# rotation timer expiries earlier than this before the end of the current rotation
+# belong to a previous (superseded) rotation
+ROTATION_DEADLINE_MARGIN = 0.01 # [s]
+
+# line drawn in the logs when asked on the 'log_line' topic
+LOG_LINE = "---------------------------\n"
+
+### QOS
+
+# sensor-like topics: only the freshest message is useful, older ones must be dropped
+# instead of queuing behind slow callbacks (map analysis, path planning)
+LATEST_ONLY_QOS = QoSProfile(depth = 1,
+        history = QoSHistoryPolicy.RMW_QOS_POLICY_HISTORY_KEEP_LAST,
+        reliability = QoSReliabilityPolicy.RMW_QOS_POLICY_RELIABILITY_BEST_EFFORT)
+
 class Controller1(Node):
     """
     Controller of the ROBOT
@@ -70,35 +115,66 @@ class Controller1(Node):
     def __init__(self):
         super().__init__("controller1")
 
+        # callback groups: the map callback (heavy, path planning) runs on its own so that it
+        # never blocks the other callbacks (lidar obstacle check, arduino status, timers...)
+        # Concurrency rules:
+        # - path, path_tail, zones, targets and goal are only written by the map callback
+        # - the other callbacks may write state, has_to_find_new_path and is_traveling_forward
+        #   (single assignments), and the rotation bookkeeping (under rotation_lock)
+        self.map_cbg = MutuallyExclusiveCallbackGroup()
+        # only the lidar stop check is reentrant: a scan must never wait for the previous one
+        self.safety_cbg = ReentrantCallbackGroup()
+        # robot position and arduino status are ordered streams (e.g. kick ass statuses 1 -> 3 -> 4)
+        # which rewrite the state: handle them one message at a time
+        self.status_cbg = MutuallyExclusiveCallbackGroup()
+        # detectnet callback and detection timer both flip the camera: never run them together
+        self.detection_cbg = MutuallyExclusiveCallbackGroup()
+        # the rotation timer is a re-armed one-shot: a second expiry must never run
+        # while the first one is still being handled
+        self.rotation_cbg = MutuallyExclusiveCallbackGroup()
+        # the rotation timer and its state can be used from several threads at once
+        self.rotation_lock = threading.RLock()
+
         # Create subscription for the map
         self.subscription1 = self.create_subscription(Position,'robot_pos',
-            self.listener_callback_position,1000)
+            self.listener_callback_position, LATEST_ONLY_QOS, callback_group = self.status_cbg)
 
         # Create subscription for the robot position
         self.subscription2 = self.create_subscription(Map,'world_map',
-            self.listener_callback_map,1000)
+            self.listener_callback_map, LATEST_ONLY_QOS, callback_group = self.map_cbg)
 
         # Create subscription for the UART reader (get signals from MC)
         self.subscription3 = self.create_subscription(Status,'arduino_status',
-            self.listener_arduino_status,1000)
+            self.listener_arduino_status, 1000, callback_group = self.status_cbg)
 
         # Create subscription for detectnet
         self.subscription_camera = self.create_subscription(Detection2DArray, '/detectnet/detections',
-            self.listener_callback_detectnet, 1000)
+            self.listener_callback_detectnet, LATEST_ONLY_QOS, callback_group = self.detection_cbg)
 
         # Create subscription for lidar
         self.subscription_lidar = self.create_subscription(LidarData, 'lidar_data',
-            self.lidar_callback, 1000)
+            self.lidar_callback, LATEST_ONLY_QOS, callback_group = self.safety_cbg)
 
         # subscription for debugng
         self.loging_ling_sub = self.create_subscription(String, 'log_line', self.log_line, 5)
 
-        # Create a publication for uart commands
-        self.uart_publisher = self.create_publisher(String, 'uart_commands', 1000)
+        # Commands are written directly to the arduino. With '--uart-topic' they are instead
+        # published on 'uart_commands' for the uart_sender node (for debugging)
+        # the commands never change: build their messages (or bytes) once and reuse them
+        self.is_using_uart_topic = "--uart-topic" in sys.argv
+        if self.is_using_uart_topic:
+            self.uart_publisher = self.create_publisher(String, 'uart_commands', COMMANDS_QOS)
+            self.uart_commands = {c: String(data = c) for c in COMMANDS}
+        else:
+            # (writes are made by a dedicated thread: callbacks never block on the serial port,
+            # '--realtime' pins that thread with a real-time priority)
+            self.uart_writer = UARTWriter(open_serial_port(self.get_logger()), self.get_logger(), 
+                    is_realtime = "--realtime" in sys.argv)
+            self.uart_commands = {c: c.encode() for c in COMMANDS}
 
         # create publisher for controlling the camera
         self.cam_publisher = self.create_publisher(String, 'detectnet/camera_control', 1000)
-        self.set_detectnet_state(DETECTNET_OFF)
+        self.set_detectnet_state(False)
 
         # create publisher for flipping camera
         self.camera_flip_topic = self.create_publisher(String, 'video_source/flip_topic', 1000)
@@ -118,25 +194,70 @@ class Controller1(Node):
         self.initial_zones_found = False
         self.zones = np.array([])
         self.path = np.array([])
+        self.path_orientations = np.array([])
+        # index of the point of the path where the robot currently is (points after it are passed)
+        self.path_tail = -1
         self.targets = []
         self.goal = None
         self.robot_pos = None
         self.current_target_index = 0
-        self.rotation_timer = None
+        # = TARGETS_TO_VISIT[self.current_target_index], kept up to date by 'next_target'
+        self.current_target = TARGETS_TO_VISIT[0]
+        # a single timer is used for all the rotations: it is re-armed with the required period
+        self.rotation_timer = self.create_timer(1, self.rotation_timer_callback, callback_group = self.rotation_cbg)
+        self.rotation_timer.cancel()
+        # same for the timer that waits for detections
+        self.wait_for_detectnet_timer = self.create_timer(TIME_FOR_VISION_DETECTION, self.detection_timer_callback, 
+                callback_group = self.detection_cbg)
+        self.wait_for_detectnet_timer.cancel()
         self.lidar_save_index = None
         self.n_random_search = 0
         self.bottles_picked = 0
-        self.state = INITIAL_ROTATION_MODE
-        self.rotation_timer_state = TIMER_STATE_OFF
+        self.state = State.INITIAL_ROTATION
         self.is_traveling_forward = False
         self.has_to_find_new_path = False
+        self.last_plan_pos = None
+        self.last_plan_time = 0
         self.lidar_should_detect_bottles = False
-        self.rotation_index = 0
+        # last rotation asked to the robot
+        self.rotation = RotationState()
+        # scratch buffer for the robot pose (x, y, theta), reused by the lidar callback
+        self.robot_pose = np.empty(3)
+
+        # handlers of the arduino status, for each state
+        self.arduino_handlers = {
+                State.INITIAL_ROTATION: self.arduino_in_initial_rotation_mode,
+                State.BOTTLE_REACHING: self.arduino_in_bottle_reaching_mode,
+                State.BOTTLE_PICKING: self.arduino_in_bottle_picking_mode,
+                State.BOTTLE_RELEASE: self.arduino_in_bottle_release_mode,
+                State.RECOVERY_SLAM: self.arduino_in_recovery_slam,
+                State.RECOVERY_ROTATION: self.arduino_in_recovery_rotation,
+                State.KICK_ASS: self.arduino_in_kick_ass_mode,
+                }
+
+        # what to do once the rotation timer fires, for each timer state
+        self.rotation_timer_handlers = {
+                TimerState.RANDOM_SEARCH_BOTTLE_ALIGNMENT: self.rotation_done_bottle_alignment,
+                TimerState.RANDOM_SEARCH_DELTA_ROTATION: self.rotation_done_delta_rotation,
+                TimerState.TRAVEL_MODE: self.rotation_done_travel_mode,
+                TimerState.BOTTLE_RELEASE: self.rotation_done_bottle_release,
+                TimerState.NO_ROTATION: self.rotation_done_no_rotation,
+                TimerState.KICK_ASS_MODE: self.rotation_done_kick_ass_mode,
+                TimerState.TRAVEL_MODE_END: self.rotation_done_travel_mode_end,
+                }
+
+        # lidar messages are only relevant in some states: one handler per state
+        self.lidar_handlers = {
+                State.BOTTLE_REACHING: self.lidar_in_bottle_reaching_mode,
+                State.TRAVEL: self.lidar_in_travel_mode,
+                State.BOTTLE_RELEASE: self.lidar_in_bottle_release_mode,
+                }
 
         # DEBUG
         # set saving state (if True, then it will save some maps to a folder when they can be analysed)
         args = sys.argv
         self.args = args
+        self.is_debugging_travel = "--travel" in args
         self.is_saving = "--save" in args
         self.is_plotting = "--plot" in args
         self.saving_index = 0
@@ -156,6 +277,10 @@ class Controller1(Node):
                 self.SAVE_TIME_CONSTANT = int(args[idx+2])
             except:
                 pass
+        if self.is_saving or self.is_plotting:
+            # figures are made by 'plotting_loop' (on the main thread, see 'main'),
+            # which only keeps the latest request
+            self.plot_queue = queue.Queue(maxsize = 1)
         print("Controller is ready: Is Ploting ? {}  - Is Saving ? {} - rate = {}".format(self.is_plotting, self.is_saving, self.SAVE_TIME_CONSTANT))
 
         # for debugging
@@ -163,27 +288,27 @@ class Controller1(Node):
             self.start_travel_mode()
 
         if "--search" in args:
-            self.state = RANDOM_SEARCH_MODE
+            self.state = State.RANDOM_SEARCH
             self.start_random_search_detection()
 
         if "--reach" in args:
-            self.state = BOTTLE_REACHING_MODE
+            self.state = State.BOTTLE_REACHING
             #self.lidar_save_index = 0
 
 
         # STATE MACHINE
-        # send a request for continuous rotation after waiting 1 second for UART node to be ready
+        # send a request for continuous rotation after waiting 1 second for UART to be ready
         # todo: change '0' to '3' when launching controller1 within launch file
         time.sleep(2)
-        if self.state == INITIAL_ROTATION_MODE:
-            self.uart_publisher.publish(String(data = "r"))
+        if self.state == State.INITIAL_ROTATION:
+            self.send_command("r")
 
 
     ### CALLBACKS
     # callbacks are the entry points to all other methods
 
     def listener_callback_map(self, map_message):
-        if self.state == TRAVEL_MODE:
+        if self.state == State.TRAVEL:
             self.travel_mode(map_message)
 
     def listener_callback_position(self, pos):
@@ -195,34 +320,47 @@ class Controller1(Node):
         self.theta = pos.theta % 360
 
     def lidar_callback(self, msg):
-        if "--travel" in self.args: 
-            if self.robot_pos is None or self.zones is None or not len(self.robot_pos) or self.theta is None:
-                return
-            is_rock, angle = controller_utils.is_obstacle_a_rock(np.concatenate((self.robot_pos, [self.theta]), axis = 0), 
-                    self.zones)
-
-        if self.state == BOTTLE_REACHING_MODE:
-            obstacle_detected = lidar_utils.check_obstacle_ahead(msg.distances, msg.angles, threshold_low = 15) 
-            if obstacle_detected: 
-                print("Obstacle detected AHEAD of lidar. Let's STOP. Bottle Picking Mode")
-                self.uart_publisher.publish(String(data="x"))
-                self.start_rotation_timer(DELTA_RANDOM_SEARCH, TIMER_STATE_ON_RANDOM_SEARCH_DELTA_ROTATION)
-
-        elif self.state == TRAVEL_MODE and self.is_traveling_forward:
-            print("checking with LIDAR")
-            obstacle_detected = lidar_utils.check_obstacle_ahead(msg.distances, msg.angles, length_to_check = 350) 
-            if obstacle_detected:
-                print("Obstacle detected AHEAD of lidar. Let's STOP. Travel MODE")
-                self.uart_publisher.publish(String(data="x"))
-                self.has_to_find_new_path = True
+        """Called at the lidar rate: dispatch the scan to the handler of the current state, if any"""
+        handler = self.lidar_handlers.get(self.state)
+        if handler is not None:
+            # (views on the message buffers: the scan is never copied)
+            distances = np.frombuffer(msg.distances, dtype = np.float64)
+            angles = np.frombuffer(msg.angles, dtype = np.float64)
+            handler(distances, angles)
+
+    def lidar_in_bottle_reaching_mode(self, distances, angles):
+        obstacle_detected = lidar_utils.check_obstacle_ahead(distances, angles, threshold_low = 15) 
+        if obstacle_detected: 
+            print("Obstacle detected AHEAD of lidar. Let's STOP. Bottle Picking Mode")
+            self.send_command("x")
+            self.start_rotation_timer(DELTA_RANDOM_SEARCH, TimerState.RANDOM_SEARCH_DELTA_ROTATION)
+
+    def lidar_in_travel_mode(self, distances, angles):
+        if not self.is_traveling_forward:
+            return
 
-        elif self.state == BOTTLE_RELEASE_MODE and self.is_traveling_forward:
-            obstacle_detected = lidar_utils.check_obstacle_ahead(msg.distances, msg.angles, length_to_check = 700) 
-            if obstacle_detected:
-                print("Obstacle detected AHEAD of lidar. HOME DETECTED ! ")
-                self.is_traveling_forward = False
-                self.uart_publisher.publish(String(data="x"))
-                self.uart_publisher.publish(String(data="q"))
+        if self.is_debugging_travel and self.robot_pos is not None and len(self.robot_pos):
+            self.robot_pose[:2] = self.robot_pos
+            self.robot_pose[2] = self.theta
+            is_rock, angle = controller_utils.is_obstacle_a_rock(self.robot_pose, self.zones)
+
+        self.get_logger().debug("checking with LIDAR")
+        obstacle_detected = lidar_utils.check_obstacle_ahead(distances, angles, length_to_check = 350) 
+        if obstacle_detected:
+            print("Obstacle detected AHEAD of lidar. Let's STOP. Travel MODE")
+            self.send_command("x")
+            self.has_to_find_new_path = True
+
+    def lidar_in_bottle_release_mode(self, distances, angles):
+        if not self.is_traveling_forward:
+            return
+
+        obstacle_detected = lidar_utils.check_obstacle_ahead(distances, angles, length_to_check = 700) 
+        if obstacle_detected:
+            print("Obstacle detected AHEAD of lidar. HOME DETECTED ! ")
+            self.is_traveling_forward = False
+            self.send_command("x")
+            self.send_command("q")
 
 
     def listener_arduino_status(self, status_msg):
@@ -232,91 +370,95 @@ class Controller1(Node):
         1: SUCESS
         2: IN PROGRESS
         """
-        status = status_msg.status
-        if self.state == INITIAL_ROTATION_MODE:
-            if status == 1:
-                print("* Initial Rotation Mode --> Travel Mode")
-                self.start_travel_mode()
+        handler = self.arduino_handlers.get(self.state)
+        if handler is not None:
+            handler(status_msg.status)
 
-        elif self.state == BOTTLE_REACHING_MODE:
-            if status == 0: 
-                # = max distance reached
-                print("Robot advanced maximum distance in 'y' mode")
-                self.start_random_search_detection()
-            elif status == 1:
-                print("Robot finished reaching")
-                # = there is a small obstacle ahead of the robot, lets pick it ! 
-                self.state = BOTTLE_PICKING_MODE
-                self.uart_publisher.publish(String(data="p"))
-
-        elif self.state == BOTTLE_PICKING_MODE:
-            if status == 0:
-                # = no bottle were detected by the robot arm 
-                self.start_random_search_detection()
-            elif status == 1: # robot picked the bottle 
-                print("Bottles picked: ", self.bottles_picked)
-                self.bottles_picked += 1
-                self.start_random_search_detection()
-
-        elif self.state == BOTTLE_RELEASE_MODE:
-            if status == 1:
-                print("Release is finished")
-                self.bottles_picked = 0
-                self.n_random_search = 0
-                self.start_travel_mode()
+    def arduino_in_initial_rotation_mode(self, status):
+        if status == 1:
+            print("* Initial Rotation Mode --> Travel Mode")
+            self.start_travel_mode()
 
-        elif self.state == RECOVERY_SLAM:
-            if status == 1:
-                print("Slam recovery arduino")
-                # we assume that arduino could handle properly the rescue
-                self.slam_control_publisher.publish(String(data="recover_state"))
-                # go back to travel mode
-                self.start_travel_mode()
+    def arduino_in_bottle_reaching_mode(self, status):
+        if status == 0: 
+            # = max distance reached
+            print("Robot advanced maximum distance in 'y' mode")
+            self.start_random_search_detection()
+        elif status == 1:
+            print("Robot finished reaching")
+            # = there is a small obstacle ahead of the robot, lets pick it ! 
+            self.state = State.BOTTLE_PICKING
+            self.send_command("p")
+
+    def arduino_in_bottle_picking_mode(self, status):
+        if status == 0:
+            # = no bottle were detected by the robot arm 
+            self.start_random_search_detection()
+        elif status == 1: # robot picked the bottle 
+            print("Bottles picked: ", self.bottles_picked)
+            self.bottles_picked += 1
+            self.start_random_search_detection()
 
-        elif self.state == RECOVERY_ROTATION:
-            if status == 1:
-                # robot moved foward. 
-                # we must start again the rotation with was unsucessful
-                self.state = self.last_state
-                print("Rotation recovery arduino")
-                self.start_rotation_timer(self.rotation_asked, self.rotation_timer_state)
-
-        elif self.state == KICK_ASS_MODE:
-            if status == 1:
-                print("[Arduino says]: we start the approach")
-                # robot reached the bottles and is ready to start the KICK ASS BACK ATTACK
-                self.slam_control_publisher.publish(String(data="freeze"))
-                self.uart_publisher.publish(String(data="c"))
-            if status == 3: 
-                print("[Arduino wonders]: mission successful (?)")
-                # robot has finished the kick ass mode.
-                # try to create SLAM again
-                self.slam_control_publisher.publish(String(data="unfreeze"))
-            if status == 4:
-                ##### self.start_rotation_timer(1, TIMER_STATE_ON_NO_ROTATION)
-                # = SLAM has waited and it is now time to start again the random search
-                print("[Arduino says]: Waiting time is finished, SLAM ready to go")
-                dest = TARGETS_TO_VISIT[self.current_target_index]
-                is_going_home = dest == 0
-                if is_going_home:
-                    print("going home")
-                    self.start_travel_mode()
-                else:
-                    print("starting random seach inside rocks")
-                    self.n_random_search = N_RANDOM_SEARCH_MAX - 10
-                    self.bottles_picked = MAX_BOTTLE_PICKED - 3
-                    self.start_random_search_detection()
+    def arduino_in_bottle_release_mode(self, status):
+        if status == 1:
+            print("Release is finished")
+            self.bottles_picked = 0
+            self.n_random_search = 0
+            self.start_travel_mode()
 
+    def arduino_in_recovery_slam(self, status):
+        if status == 1:
+            print("Slam recovery arduino")
+            # we assume that arduino could handle properly the rescue
+            self.slam_control_publisher.publish(String(data="recover_state"))
+            # go back to travel mode
+            self.start_travel_mode()
 
+    def arduino_in_recovery_rotation(self, status):
+        if status == 1:
+            # robot moved foward. 
+            # we must start again the rotation with was unsucessful
+            self.state = self.last_state
+            print("Rotation recovery arduino")
+            self.start_rotation_timer(self.rotation.angle, self.rotation.state)
+
+    def arduino_in_kick_ass_mode(self, status):
+        if status == 1:
+            print("[Arduino says]: we start the approach")
+            # robot reached the bottles and is ready to start the KICK ASS BACK ATTACK
+            self.slam_control_publisher.publish(String(data="freeze"))
+            self.send_command("c")
+        if status == 3: 
+            print("[Arduino wonders]: mission successful (?)")
+            # robot has finished the kick ass mode.
+            # try to create SLAM again
+            self.slam_control_publisher.publish(String(data="unfreeze"))
+        if status == 4:
+            ##### self.start_rotation_timer(1, TimerState.NO_ROTATION)
+            # = SLAM has waited and it is now time to start again the random search
+            print("[Arduino says]: Waiting time is finished, SLAM ready to go")
+            dest = self.current_target
+            is_going_home = dest == 0
+            if is_going_home:
+                print("going home")
+                self.start_travel_mode()
+            else:
+                print("starting random seach inside rocks")
+                self.n_random_search = N_RANDOM_SEARCH_MAX - 10
+                self.bottles_picked = MAX_BOTTLE_PICKED - 3
+                self.start_random_search_detection()
 
     def listener_callback_detectnet(self, msg):
         """Called when a bottle is detected by neuron network
         This function can only be called when the neuron network is active, 
-        i.e. only in RANDOM_SEARCH_MODE when the robot is still and waiting for detection
+        i.e. only in RANDOM_SEARCH state when the robot is still and waiting for detection
         """
         # we must verify that the detectnet is really suppose to be turned ON
-        if self.detectnet_state == DETECTNET_OFF: 
+        if not self.detectnet_on: 
             return 
+        n_detections = len(msg.detections)
+        if n_detections == 0:
+            return
         # we must verify that actual flip state is the same as expected flip state
         source_img = msg.detections[0].source_img
         is_actually_flipped = source_img.height < source_img.width
@@ -324,10 +466,14 @@ class Controller1(Node):
             return
 
         # 1. extract the detection
+        # one row per detection: (x, y, size_x, size_y, is_flipped)
         print("    Detections successful")
-        new_detections = [(d.bbox.center.x, d.bbox.center.y, d.bbox.size_x, d.bbox.size_y, self.is_flipped) for d in msg.detections]
-        print(new_detections, msg.detections[0].source_img.width)
-        self.detections += new_detections
+        new_detections = np.empty((n_detections, 5))
+        for i, d in enumerate(msg.detections):
+            bbox = d.bbox
+            new_detections[i] = (bbox.center.x, bbox.center.y, bbox.size_x, bbox.size_y, self.is_flipped)
+        print(new_detections, source_img.width)
+        self.detections.append(new_detections)
 
         # 2. flip the camera
         self.flip_camera_and_reset_detectnet_timer()
@@ -342,13 +488,13 @@ class Controller1(Node):
     def flip_camera_and_reset_detectnet_timer(self):
         msg = "normal" if self.is_flipped else "flip"
         self.camera_flip_topic.publish(String(data=msg))
-        self.destroy_timer(self.wait_for_detectnet_timer)
+        self.wait_for_detectnet_timer.cancel()
         self.is_flipped = not self.is_flipped
         if self.is_flipped:
             # = first lap is finished 
             # create a callback in some time to observe bottles around robot
             print("    Trying to detect again with a new flip")
-            self.wait_for_detectnet_timer = self.create_timer(TIME_FOR_VISION_DETECTION, self.detection_timer_callback)
+            self.wait_for_detectnet_timer.reset()
         else:
             # = nothing was detected during the second lap
             # get the best bottle to go to
@@ -359,95 +505,119 @@ class Controller1(Node):
         - a bottle to pick 
         - another rotation
         """
-        self.set_detectnet_state(DETECTNET_OFF)
-        if len(self.detections):
+        self.set_detectnet_state(False)
+        # detections are stored as one array per message: merge them once here, and give them
+        # to vision_utils in its own format (list of tuples, with a bool 'is_flipped')
+        if self.detections:
+            detections = [(x, y, w, h, bool(is_flipped)) 
+                    for x, y, w, h, is_flipped in np.concatenate(self.detections, axis = 0).tolist()]
+        else:
+            detections = []
+        if len(detections):
             # get best detection
-            detection = vision_utils.get_best_detections(self.detections)
+            detection = vision_utils.get_best_detections(detections)
             # move to bottle
             angle = vision_utils.get_angle_of_detection(detection)
             print("starting timer after detection of bottle, with angle:",angle)
-            self.start_rotation_timer(angle, TIMER_STATE_ON_RANDOM_SEARCH_BOTTLE_ALIGNMENT)
+            self.start_rotation_timer(angle, TimerState.RANDOM_SEARCH_BOTTLE_ALIGNMENT)
         else:
             # lets start a rotation of 30 degrees again
             print("    No bottle detected at all --> start again a rotation")
-            self.start_rotation_timer(DELTA_RANDOM_SEARCH, TIMER_STATE_ON_RANDOM_SEARCH_DELTA_ROTATION)
+            self.start_rotation_timer(DELTA_RANDOM_SEARCH, TimerState.RANDOM_SEARCH_DELTA_ROTATION)
 
     def rotation_timer_callback(self):
         """Called when robot has turned enough to pick the bottle"""
-        print("ROTATION CALLBACK ", self.rotation_index)
-        self.destroy_timer(self.rotation_timer)
+        with self.rotation_lock:
+            self.rotation_done()
+
+    def rotation_done(self):
+        if self.get_logger().is_enabled_for(LoggingSeverity.DEBUG):
+            self.get_logger().debug("ROTATION CALLBACK {}".format(self.rotation.index))
+        # the timer is only cancelled from here (its own callback group): cancelling it from
+        # another thread can make the executor fail on an expiry it already picked up
+        if self.rotation.state == TimerState.OFF:
+            # the rotation was stopped (e.g. by travel_mode) after this expiry was dispatched
+            self.rotation_timer.cancel()
+            return
 
-        if self.rotation_timer_state == TIMER_STATE_OFF:
-            print("Timer was OFF and yet trigered")
+        if time.monotonic() < self.rotation.deadline - ROTATION_DEADLINE_MARGIN:
+            # expiry of a rotation which was superseded by a new one: the timer was re-armed
+            # and will fire again when the new rotation is finished
+            return
+
+        # (one shot timer)
+        self.rotation_timer.cancel()
 
         # verify that rotation actually happened
-        if np.abs(self.rotation_asked) > 39:
-            if np.abs(controller_utils.angle_diff(self.last_theta, self.theta)) < 5:
-                print("ROTATION ERROR ! index: ", self.rotation_index)
-                print(self.last_theta)
+        if abs(self.rotation.angle) > 39:
+            if abs(controller_utils.angle_diff(self.rotation.theta, self.theta)) < 5:
+                print("ROTATION ERROR ! index: ", self.rotation.index)
+                print(self.rotation.theta)
                 print(self.theta)
-                print(controller_utils.angle_diff(self.last_theta, self.theta))
+                print(controller_utils.angle_diff(self.rotation.theta, self.theta))
                 # ask arduino to move forward (just a little bit) and wait for answer
-                self.uart_publisher.publish(String(data="W"))
+                self.send_command("W")
                 self.last_state = self.state
-                self.state = RECOVERY_ROTATION
+                self.state = State.RECOVERY_ROTATION
                 return 
 
-        if self.rotation_timer_state == TIMER_STATE_ON_RANDOM_SEARCH_BOTTLE_ALIGNMENT:
-            print("    Robot is in front of bottle")
-            # change timer state and go to bottle picking mode.
-            self.rotation_timer_state = TIMER_STATE_OFF
-            self.start_bottle_reaching_mode()
-
-        elif self.rotation_timer_state == TIMER_STATE_ON_RANDOM_SEARCH_DELTA_ROTATION:
-            print("    Robot delta rotation finished")
-            self.rotation_timer_state = TIMER_STATE_OFF
-            self.uart_publisher.publish(String(data="x"))
-            # start detection again
-            self.start_random_search_detection()
-
-        elif self.rotation_timer_state == TIMER_STATE_ON_TRAVEL_MODE:
-            # change timer state and start moving forward.
-            self.rotation_timer_state = TIMER_STATE_OFF
-            print("    Rotated time reached. Let's move forward.")
-            self.uart_publisher.publish(String(data="w"))
-
-        elif self.rotation_timer_state == TIMER_STATE_ON_BOTTLE_RELEASE:
-            # = robot is aligned with the recycling area
-            print("Ready to move forward")
-            self.rotation_timer_state = TIMER_STATE_OFF
-            self.is_traveling_forward = True
-            self.uart_publisher.publish(String(data="m2"))
-            self.uart_publisher.publish(String(data="w"))
-
-        elif self.rotation_timer_state == TIMER_STATE_ON_NO_ROTATION:
-            print("Waiting time finished.")
-
-        elif self.rotation_timer_state == TIMER_STATE_ON_KICK_ASS_MODE: 
-            print("We are ready Arduino ! Take care of us.... (Sending 'Y')")
-            self.rotation_timer_state = TIMER_STATE_OFF
-            # 2. start communication with Arduino 
-            # the continuation is in arduino callback
-            self.uart_publisher.publish(String(data="Y"))
-
-        elif self.rotation_timer_state == TIMER_STATE_ON_TRAVEL_MODE_END:
-            self.rotation_timer_state = TIMER_STATE_OFF
-            self.start_random_search_detection()
+        handler = self.rotation_timer_handlers.get(self.rotation.state)
+        if handler is not None:
+            handler()
+
+    def rotation_done_bottle_alignment(self):
+        print("    Robot is in front of bottle")
+        # change timer state and go to bottle picking mode.
+        self.rotation.state = TimerState.OFF
+        self.start_bottle_reaching_mode()
+
+    def rotation_done_delta_rotation(self):
+        print("    Robot delta rotation finished")
+        self.rotation.state = TimerState.OFF
+        self.send_command("x")
+        # start detection again
+        self.start_random_search_detection()
+
+    def rotation_done_travel_mode(self):
+        # change timer state and start moving forward.
+        self.rotation.state = TimerState.OFF
+        print("    Rotated time reached. Let's move forward.")
+        self.send_command("w")
+
+    def rotation_done_bottle_release(self):
+        # = robot is aligned with the recycling area
+        print("Ready to move forward")
+        self.rotation.state = TimerState.OFF
+        self.is_traveling_forward = True
+        self.send_command("m2")
+        self.send_command("w")
+
+    def rotation_done_no_rotation(self):
+        print("Waiting time finished.")
+
+    def rotation_done_kick_ass_mode(self):
+        print("We are ready Arduino ! Take care of us.... (Sending 'Y')")
+        self.rotation.state = TimerState.OFF
+        # 2. start communication with Arduino 
+        # the continuation is in arduino callback
+        self.send_command("Y")
+
+    def rotation_done_travel_mode_end(self):
+        self.rotation.state = TimerState.OFF
+        self.start_random_search_detection()
 
     ### STATE MACHINE METHODS
 
-    def set_detectnet_state(self, new_state):
-        self.detectnet_state = new_state
-        if new_state == DETECTNET_ON:
-            self.cam_publisher.publish(String(data="create"))
-        if new_state == DETECTNET_OFF:
-            self.cam_publisher.publish(String(data="destroy"))
+    def set_detectnet_state(self, is_on):
+        """Turns the detectnet ON (True) or OFF (False)"""
+        self.detectnet_on = is_on
+        self.cam_publisher.publish(String(data="create" if is_on else "destroy"))
 
     def start_random_search_detection(self):
         """Will start the random search and increase by 1 the stepper
         """
         print("* Random search activated, n = ", self.n_random_search)
-        self.state = RANDOM_SEARCH_MODE
+        self.state = State.RANDOM_SEARCH
         self.n_random_search += 1
 
         # ending criterion 
@@ -456,19 +626,19 @@ class Controller1(Node):
             print("Leaving random search")
             # no more random walk can happen
             # let's enter travel mode again
-            self.set_detectnet_state(DETECTNET_OFF)
+            self.set_detectnet_state(False)
             self.start_travel_mode()
             return
 
         # set lower speed
-        self.uart_publisher.publish(String(data = "xm2"))
+        self.send_command("xm2")
 
         # create subscription for detection
-        self.set_detectnet_state(DETECTNET_ON)
+        self.set_detectnet_state(True)
 
         # create a callback in some time to observe bottles around robot
         self.detections = []
-        self.wait_for_detectnet_timer = self.create_timer(TIME_FOR_VISION_DETECTION, self.detection_timer_callback)
+        self.wait_for_detectnet_timer.reset()
 
     def travel_mode(self, map_message):
         """Travel mode of the controller.
@@ -477,26 +647,41 @@ class Controller1(Node):
         # compute robot position (used a lot)
         self.robot_pos = map_utils.pos_to_gridpos(self.x, self.y)
 
-        if self.rotation_timer_state == TIMER_STATE_ON_TRAVEL_MODE_END:
+        if self.rotation.state == TimerState.TRAVEL_MODE_END:
             return 
 
+        if self.current_target is None:
+            # all the targets were visited
+            return
+
         ### I. Path planning
-        # Once in a while, start the path planning logic
-        if int(map_message.index) % CONTROLLER_TIME_CONSTANT == 0 or self.has_to_find_new_path:
+        # Start the path planning logic when asked to, or when the path is outdated
+        # (the robot moved a lot since it was computed, or it is too old)
+        has_moved = self.last_plan_pos is not None and math.hypot(self.robot_pos[0] - self.last_plan_pos[0], 
+                self.robot_pos[1] - self.last_plan_pos[1]) > REPLAN_DISTANCE
+        is_path_old = time.time() - self.last_plan_time > REPLAN_MAX_AGE
+        if self.has_to_find_new_path or has_moved or is_path_old:
             print("    map analysis", int(map_message.index))
+            # clear the request now, not after the plan: the lidar callback runs concurrently
+            # and may ask for a new path (obstacle) while this one is being computed
+            self.has_to_find_new_path = False
 
             ## Handling timer problem
-            if self.rotation_timer_state == TIMER_STATE_ON_TRAVEL_MODE:
-                print("Stopping current timer and let's compute a new path to follow")
-                self.uart_publisher.publish(String(data = "x"))
-                self.rotation_timer_state = TIMER_STATE_OFF
-                self.destroy_timer(self.rotation_timer)
+            with self.rotation_lock:
+                if self.rotation.state == TimerState.TRAVEL_MODE:
+                    print("Stopping current timer and let's compute a new path to follow")
+                    self.send_command("x")
+                    # (the timer will cancel itself when it fires)
+                    self.rotation.state = TimerState.OFF
 
             ## Map analysis
             # a. filter the map
-            map_data = bytearray(map_message.map_data)
+            # (view on the message buffer: avoids copying the whole grid)
+            map_data = np.frombuffer(map_message.map_data, dtype = np.uint8)
             m = map_utils.get_map(map_data)
             binary_dilated, binary = map_utils.filter_map(m, dilation_kernel_size = 14)
+            # the planner reads the obstacle grid pixel by pixel: give it a compact byte grid
+            binary_dilated = np.ascontiguousarray(binary_dilated, dtype = np.uint8)
             
             # np.save("/home/arthur/dev/ros/data/maps/test30m.npy", m)
 
@@ -505,6 +690,7 @@ class Controller1(Node):
                 corners, area, contours = map_utils.get_bounding_rect(binary)
             except:
                 print("Contours not found... yet ?")
+                self.has_to_find_new_path = True
                 return
 
             # save binary if we are going to make some plots
@@ -534,8 +720,8 @@ class Controller1(Node):
                     self.zones = new_zones
                 else:
                     print("RECOVERY MODE STARTED")
-                    self.state = RECOVERY_SLAM
-                    self.uart_publisher.publish(String(data="R"))
+                    self.state = State.RECOVERY_SLAM
+                    self.send_command("R")
                     return 
 
                 ## Path Planing
@@ -543,31 +729,32 @@ class Controller1(Node):
                 self.targets = map_utils.get_targets_from_zones(np.array(self.zones))
 
                 # e. rrt_star path planning
-                self.goal = self.targets[TARGETS_TO_VISIT[self.current_target_index]]
+                self.goal = self.targets[self.current_target]
                 random_area = map_utils.get_random_area(self.zones)
                 print("    - will find path")
                 rrt = RRTStar(start = self.robot_pos, goal = self.goal, binary_obstacle = binary_dilated, 
                         rand_area = random_area, expand_dis = 50, path_resolution = 1,
                         goal_sample_rate = 5, max_iter = 500)
-                self.path = np.array(rrt.planning(animation = True))
-                self.has_to_find_new_path = False
+                # never draw the tree: the plotting loop already shows the final path
+                self.set_path(rrt.planning(animation = False))
+                self.last_plan_pos = self.robot_pos
+                self.last_plan_time = time.time()
                 print("    - path found")
 
         # (make and save the nice figure)
         if (self.is_saving or self.is_plotting) and int(map_message.index) % self.SAVE_TIME_CONSTANT == 0:
             name = self.map_name+str(self.saving_index)
             save_name = "/home/arthur/dev/ros/data/maps/rects/"+name+".png" if self.is_saving else ""
-            text = ""
             try:
-                img = map_utils.make_nice_plot(self.binary, save_name, self.robot_pos,
+                # (the arrays are replaced, never modified, by the controller: no need to copy them)
+                plot_args = (self.binary, save_name, self.robot_pos,
                         self.theta, self.contours, self.corners,
-                        self.zones, self.targets, self.path.astype(int),
-                        text = text)
-                if self.is_plotting:
-                    self.live_vizualiser.display(np.array(img))
-                print("-----> saving index: ", self.saving_index, int(map_message.index))
+                        self.zones, self.targets, self.path[:self.path_tail + 1].astype(int))
+                self.plot_queue.put_nowait((plot_args, self.saving_index, int(map_message.index)))
                 self.saving_index += 1
-                # np.save("/home/arthur/dev/ros/data/maps/"+name+".npy", m)
+            except queue.Full:
+                # previous figure is not finished yet: drop this one
+                pass
             except:
                 print("Could not save")
 
@@ -579,27 +766,29 @@ class Controller1(Node):
             print("NO PATH FOUND.....")
             return 
 
-        if len(self.path) == 0 or self.goal is None: 
-            print("...")
+        if self.path_tail < 1 or self.goal is None: 
+            self.get_logger().debug("...")
             return
 
         # 1. state transition condition
-        dist = controller_utils.get_distance(self.robot_pos, self.goal)
-        reached = TARGETS_TO_VISIT[self.current_target_index]
+        # (distances are inlined: this runs on every map message)
+        robot_x, robot_y = self.robot_pos[0], self.robot_pos[1]
+        dist = math.hypot(robot_x - self.goal[0], robot_y - self.goal[1])
+        reached = self.current_target
         min_dist = MIN_DIST_TO_RECYCLING if reached == 0 else MIN_DIST_TO_GOAL
         if dist < min_dist:
             # robot arrived to destination
             print("Robot reached zone ", reached)
-            self.current_target_index += 1
+            self.next_target()
             self.n_random_search = 0
             self.bottles_picked = 0
             self.is_traveling_forward = False
-            self.path = []
+            self.set_path([])
             if reached in [1,2,3,4]: # robot in zone 2 or zone 3
                 # travel_mode --> random_search mode
                 line_orientation = controller_utils.get_path_orientation([self.zones[1], self.zones[0]] if reached in [1, 2] else [self.zones[3], self.zones[1]])
                 angle_diff = controller_utils.angle_diff(line_orientation, self.theta)
-                self.start_rotation_timer(angle_diff, TIMER_STATE_ON_TRAVEL_MODE_END)
+                self.start_rotation_timer(angle_diff, TimerState.TRAVEL_MODE_END)
             elif reached == 0:
                 # travel_mode --> release_bottle_mode
                 self.start_bottle_release_mode()
@@ -609,106 +798,175 @@ class Controller1(Node):
             return
 
         # 2. Else, compute motors commands
-        if self.rotation_timer_state == TIMER_STATE_ON_TRAVEL_MODE: 
+        if self.rotation.state == TimerState.TRAVEL_MODE: 
             return
 
-        path_orientation = controller_utils.get_path_orientation(self.path)
+        if self.has_to_find_new_path:
+            # the lidar stopped the robot (maybe during the planning above): 
+            # do not restart the motors before the path is recomputed
+            return
+
+        path_orientation = self.path_orientations[self.path_tail - 1]
         diff = controller_utils.angle_diff(path_orientation, self.theta)
 
         if abs(diff) > MIN_ANGLE_DIFF:
             ## ROTATION CORRECTION SUB-STATE
             print("    rotation correction with diff = ", diff)
             self.is_traveling_forward = False
-            self.start_rotation_timer(diff, TIMER_STATE_ON_TRAVEL_MODE)
+            self.start_rotation_timer(diff, TimerState.TRAVEL_MODE)
 
         else:
             ## FORWARD SUB-STATE
             # in theory, robot should be going forward.
             # send a forward message just in case it wasn't lunched before
-            self.uart_publisher.publish(String(data = "w"))
+            self.send_command("w")
             self.is_traveling_forward = True
             # compute distance to next point of the path
-            p = self.path[-2]
-            dist_to_next_point = controller_utils.get_distance(self.robot_pos, p)
-            print("    going foward for a distance {:.2f}, diff = {:.2f}".format(dist_to_next_point, diff))
+            p = self.path[self.path_tail - 1]
+            dist_to_next_point = math.hypot(robot_x - p[0], robot_y - p[1])
+            # (only format the message when it is going to be written: this runs on every map message)
+            if self.get_logger().is_enabled_for(LoggingSeverity.DEBUG):
+                self.get_logger().debug("going foward for a distance {:.2f}, diff = {:.2f}".format(dist_to_next_point, diff))
             if dist_to_next_point < MIN_DIST_TO_POINT:
-                # remove first point of the path
-                print("Will update path: ", self.path)
-                del self.path[-1]
-                print("Updated path: ", self.path)
+                # the robot passed the point: move on to the next one
+                self.path_tail -= 1
+                print("Updated path: ", self.path[:self.path_tail + 1])
 
     def start_bottle_reaching_mode(self):
         """Will start the bottle picking mode"""
         print("Robot starts bottle reaching mode")
-        self.state = BOTTLE_REACHING_MODE
-        self.uart_publisher.publish(String(data = "y"))
+        self.state = State.BOTTLE_REACHING
+        self.send_command("y")
 
     def start_travel_mode(self):
-        self.uart_publisher.publish(String(data = "m1"))
+        self.send_command("m1")
         self.has_to_find_new_path = True
-        self.state = TRAVEL_MODE
+        self.state = State.TRAVEL
 
     def start_bottle_release_mode(self):
         """Will start the bottle picking mode"""
-        self.state = BOTTLE_RELEASE_MODE
+        self.state = State.BOTTLE_RELEASE
         # 1. get angle to rotate to align robot to correct position
         diagonal_orientation = controller_utils.get_path_orientation([self.zones[0], self.zones[3]])
         angle = controller_utils.angle_diff(diagonal_orientation, self.theta)
         print("BOTTLE RELEASE with angle diff: ", angle, "values ", self.theta, diagonal_orientation)
         # 2. make the rotation
-        self.start_rotation_timer(angle, TIMER_STATE_ON_BOTTLE_RELEASE)
+        self.start_rotation_timer(angle, TimerState.BOTTLE_RELEASE)
 
     def start_kick_ass_mode(self, is_going_home):
         print("Kick the Rocks Asses")
-        self.state = KICK_ASS_MODE 
+        self.state = State.KICK_ASS 
         # 1. find the angle to rotate the robot at
         line_orientation = controller_utils.get_path_orientation([self.zones[0], self.zones[2]] if is_going_home else [self.zones[2], self.zones[0]])
         angle = controller_utils.angle_diff(line_orientation, self.theta)
-        self.start_rotation_timer(angle, TIMER_STATE_ON_KICK_ASS_MODE)
+        self.start_rotation_timer(angle, TimerState.KICK_ASS_MODE)
 
 
     ### HELPER FUNCTIONS
 
+    def send_command(self, command):
+        """Sends one of the uart_writer.COMMANDS to the arduino"""
+        if self.is_using_uart_topic:
+            self.uart_publisher.publish(self.uart_commands[command])
+        else:
+            self.uart_writer.write(self.uart_commands[command])
+
+    def next_target(self):
+        """Moves on to the next zone to visit (None once they were all visited)"""
+        self.current_target_index += 1
+        if self.current_target_index < len(TARGETS_TO_VISIT):
+            self.current_target = TARGETS_TO_VISIT[self.current_target_index]
+        else:
+            self.current_target = None
+
+    def set_path(self, path):
+        """Stores the path to follow as an array, along with the orientation of each of its segments.
+        The robot starts at the end of the path: passed points are dropped by moving 'path_tail' backward."""
+        if path is None:
+            self.path = None
+            return
+        self.path = np.array(path)
+        self.path_tail = len(self.path) - 1
+        self.path_orientations = np.array([controller_utils.get_path_orientation(self.path[i:i+2]) 
+            for i in range(len(self.path) - 1)])
+
     def start_rotation_timer(self, angle, state):
         """Will start a timer which has a period equals to the required rotation time
         to achieve the provided angle."""
-
-        # 1. if required, delete previous timer
-        if self.rotation_timer_state is not TIMER_STATE_OFF:
-            # it means another timer was launched
-            self.destroy_timer(self.rotation_timer)
-
-        if self.rotation_timer_state == TIMER_STATE_ON_NO_ROTATION:
-            # This is a 'fake' state to wait for an amount of time without doing anything
-            time_to_rotate = angle 
-        else:
-            # 2. estimate remaining time of rotation and start new timer
-            time_to_rotate = controller_utils.get_rotation_time(np.abs(angle))
-            # 3. send the rotation motor control
-            print("        (starting rotation now)", state, angle, self.rotation_index)
-            msg = String()
-            if angle > 0: msg.data = "d"
-            else: msg.data = "a"
-            self.uart_publisher.publish(msg)
-
-        # launch the timer
-        self.rotation_timer = self.create_timer(time_to_rotate, self.rotation_timer_callback)
+        with self.rotation_lock:
+            # 1. a previous timer may still be running: it is not cancelled (see 'rotation_done'),
+            # re-arming it below restarts its period
+            if self.rotation.state == TimerState.NO_ROTATION:
+                # This is a 'fake' state to wait for an amount of time without doing anything
+                time_to_rotate = angle 
+            else:
+                # 2. estimate remaining time of rotation and start new timer
+                abs_angle = abs(angle)
+                if abs_angle <= 180:
+                    time_to_rotate = ROTATION_TIMES[int(abs_angle + 0.5)]
+                else:
+                    time_to_rotate = controller_utils.get_rotation_time(abs_angle)
+                # 3. send the rotation motor control
+                if self.get_logger().is_enabled_for(LoggingSeverity.DEBUG):
+                    self.get_logger().debug("(starting rotation now) {} {} {}".format(state.name, angle, self.rotation.index))
+                self.send_command("d" if angle > 0 else "a")
+
+            # launch the timer
+            self.rotation_timer.timer_period_ns = int(time_to_rotate * 1e9)
+            self.rotation_timer.reset()
+            self.rotation.deadline = time.monotonic() + time_to_rotate
         
-        # 4. get current state of the robot (to make sure a real rotation happened)
-        self.rotation_timer_state = state
-        self.last_theta = self.theta
-        self.rotation_asked = angle
-        self.rotation_index += 1
+            # 4. get current state of the robot (to make sure a real rotation happened)
+            rotation = self.rotation
+            rotation.state = state
+            rotation.theta = self.theta
+            rotation.angle = angle
+            rotation.index += 1
+
+    def plotting_loop(self):
+        """Makes the figures requested by the map callback, so that plotting never blocks 
+        the controller. Must run on the main thread: the plotting backends are not thread-safe."""
+        while rclpy.ok():
+            try:
+                plot_args, saving_index, map_index = self.plot_queue.get(timeout = 1)
+            except queue.Empty:
+                continue
+            try:
+                img = map_utils.make_nice_plot(*plot_args, text = "")
+                if self.is_plotting:
+                    self.live_vizualiser.display(np.array(img))
+                print("-----> saving index: ", saving_index, map_index)
+            except:
+                print("Could not save")
 
     def log_line(self, msg):
-        print("---------------------------")
+        sys.stdout.write(LOG_LINE)
+
+def spin_in_background(executor, node):
+    """Spins the executor (in a background thread). If a callback fails, ROS is shut down
+    so that the main thread stops too, as it would without the background thread."""
+    try:
+        executor.spin()
+    except Exception as e:
+        node.get_logger().error("Controller stopped: {!r}".format(e))
+        if rclpy.ok():
+            rclpy.shutdown()
+        raise
 
 def main(args=None):
     rclpy.init(args=args)
     node = Controller1()
-    rclpy.spin(node)
+    executor = MultiThreadedExecutor(num_threads = 3)
+    executor.add_node(node)
+    if node.is_saving or node.is_plotting:
+        # all the drawing stays on the main thread: callbacks are spinned in the background
+        threading.Thread(target = spin_in_background, args = (executor, node), daemon = True).start()
+        node.plotting_loop()
+    else:
+        executor.spin()
     print("Leaving code !")
-    rclpy.shutdown()
+    if rclpy.ok():
+        rclpy.shutdown()
 
 if __name__ == '__main__':
     main()
@@ -3,8 +3,13 @@ from rclpy.node import Node
 
 from std_msgs.msg import String
 
+import sys
 import time
-import serial
+
+from robottle.uart_writer import COMMANDS, COMMANDS_QOS, open_serial_port, UARTWriter
+
+# period at which the number of received commands is logged
+LOG_PERIOD = 1 # [s]
 
 class UARTSender(Node):
     """
@@ -24,25 +29,37 @@ class UARTSender(Node):
             String,
             'uart_commands',
             self.listener_callback,
-            1000)
+            COMMANDS_QOS)
         self.subscription1  # prevent unused variable warning
 
         # setup the uart port and wait a second for it
-        self.serial_port = serial.Serial(
-            # port="/dev/ttyTHS1",
-            port="/dev/ttyACM0",
-            baudrate=9600)
-            
+        self.serial_port = open_serial_port(self.get_logger())
         time.sleep(1)
         
         self.i = 0
         #self.serial_port.write("hello arduino".encode())
 
+        # the usual commands are encoded once and for all
+        self.encoded_commands = {c: c.encode() for c in COMMANDS}
+
+        # commands are written to the UART by a dedicated thread, so that the executor 
+        # never blocks on the serial port ('--realtime' pins that thread with a real-time priority)
+        self.uart_writer = UARTWriter(self.serial_port, self.get_logger(), 
+                is_realtime = "--realtime" in sys.argv)
+
+        # logging is done once in a while, out of the commands path
+        self.i_logged = 0
+        self.log_timer = self.create_timer(LOG_PERIOD, self.log_activity)
+
     def listener_callback(self, msg):
         self.i += 1
-        #if self.i % 5 == 0:
-        self.get_logger().info(msg.data)
-        self.serial_port.write(msg.data.encode())
+        payload = self.encoded_commands.get(msg.data) or msg.data.encode()
+        self.uart_writer.write(payload)
+
+    def log_activity(self):
+        if self.i != self.i_logged:
+            self.get_logger().info("{} commands received".format(self.i - self.i_logged))
+            self.i_logged = self.i
 
 
 
@@ -50,7 +67,9 @@ def main(args=None):
     rclpy.init(args=args)
     node = UARTSender()
     rclpy.spin(node)
-    rclpy.shutdown()
+    # (ROS may already be shut down by the UART writer, after a write error)
+    if rclpy.ok():
+        rclpy.shutdown()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,98 @@
+import os
+import threading
+from collections import deque
+import serial
+import rclpy
+from rclpy.qos import QoSProfile, QoSHistoryPolicy, QoSReliabilityPolicy
+
+# commands usually sent to the arduino (by the controller and by teleop)
+COMMANDS = ("w", "a", "s", "d", "x", "r", "y", "p", "q", "c", "R", "W", "Y", "m1", "m2", "xm2")
+
+# QoS of the 'uart_commands' topic
+# commands form an ordered stream (e.g. 'x' then 'q'): none can be dropped, 
+# but only a few can be waiting at once so that the robot never acts on stale ones
+COMMANDS_QOS = QoSProfile(depth = 10,
+        history = QoSHistoryPolicy.RMW_QOS_POLICY_HISTORY_KEEP_LAST,
+        reliability = QoSReliabilityPolicy.RMW_QOS_POLICY_RELIABILITY_RELIABLE)
+
+# port on which the arduino is connected
+UART_PORT = "/dev/ttyACM0"
+UART_BAUDRATE = 9600
+
+# number of commands waiting to be written to the UART above which the port is considered 
+# as lagging (commands are never dropped: they form an ordered stream, e.g. 'x' then 'q')
+TX_BACKLOG_WARNING = 64
+# max number of bytes written to the UART with a single call
+TX_MAX_BATCH = 32
+# with real-time scheduling: CPU on which the writer thread is pinned (ideally isolated with 'isolcpus'),
+# and its SCHED_FIFO priority
+WRITER_CPU = 1
+WRITER_PRIORITY = 50
+
+def open_serial_port(logger, port = UART_PORT, baudrate = UART_BAUDRATE):
+    """Opens the UART port of the arduino, in low latency mode when possible"""
+    serial_port = serial.Serial(port = port, baudrate = baudrate)
+    # ask the driver to send bytes right away instead of buffering them (ASYNC_LOW_LATENCY)
+    try:
+        serial_port.set_low_latency_mode(True)
+    except (AttributeError, ValueError) as e:
+        # (pyserial < 3.5, or the driver does not support it)
+        logger.warn("Could not set the UART in low latency mode: {}".format(e))
+    return serial_port
+
+class UARTWriter:
+    """
+    Writes payloads to the UART from a dedicated thread, so that the callers
+    (ROS callbacks) never block on the serial port.
+    Payloads are queued and written several at once when they are piling up.
+    If the port fails, the writer stops, ROS is shut down and 'write' raises.
+    """
+
+    def __init__(self, serial_port, logger, is_realtime = False):
+        self.serial_port = serial_port
+        self.logger = logger
+        self.is_realtime = is_realtime
+        self.tx_ring = deque()
+        self.tx_event = threading.Event()
+        # set (to the exception) when the port failed and nothing is written anymore
+        self.error = None
+        threading.Thread(target = self.writer_loop, daemon = True).start()
+
+    def write(self, payload):
+        """Queues some bytes to be written (can be called from any thread)"""
+        if self.error is not None:
+            raise RuntimeError("UART writer is stopped: {}".format(self.error))
+        self.tx_ring.append(payload)
+        if len(self.tx_ring) > TX_BACKLOG_WARNING:
+            self.logger.warn("UART is lagging: {} commands waiting".format(len(self.tx_ring)))
+        self.tx_event.set()
+
+    def writer_loop(self):
+        """Runs in its own thread: waits for payloads and writes them to the UART"""
+        if self.is_realtime:
+            self.set_realtime_scheduling()
+        while True:
+            self.tx_event.wait()
+            self.tx_event.clear()
+            while self.tx_ring:
+                batch = bytearray()
+                while self.tx_ring and len(batch) < TX_MAX_BATCH:
+                    batch.extend(self.tx_ring.popleft())
+                try:
+                    self.serial_port.write(batch)
+                except (serial.SerialException, OSError) as e:
+                    # (e.g. the arduino was disconnected): the robot would keep running its
+                    # last command, so stop everything instead of failing silently
+                    self.error = e
+                    self.logger.error("Could not write to the UART, stopping: {}".format(e))
+                    if rclpy.ok():
+                        rclpy.shutdown()
+                    return
+
+    def set_realtime_scheduling(self):
+        """Pins the calling thread to WRITER_CPU with a real-time priority (requires CAP_SYS_NICE)"""
+        try:
+            os.sched_setaffinity(0, {WRITER_CPU})
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(WRITER_PRIORITY))
+        except OSError as e:
+            self.logger.warn("Could not set real-time scheduling of the UART writer: {}".format(e))
@@ -12,6 +12,7 @@ setup(
             ['resource/' + package_name]),
         ('share/' + package_name, ['package.xml']),
         ('share/' + package_name, glob('launch/*.launch.py')),
+        ('share/' + package_name + '/config', glob('config/*.xml')),
     ],
     install_requires=['setuptools'],
     zip_safe=True,
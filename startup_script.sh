@@ -8,6 +8,9 @@ source /home/arthur/dev/ros/ros.sh
 # git pull
 # colcon build 
 
+# bigger DDS socket buffers (see robottle/config/fastrtps_profiles.xml)
+export FASTRTPS_DEFAULT_PROFILES_FILE=$(ros2 pkg prefix robottle)/share/robottle/config/fastrtps_profiles.xml
+
 # launch all the nodes
 # ros2 run robottle teleop & 
 ros2 launch ros_deep_learning detectnet.ros2.launch input:=csi://0 output:=display://0 & ros2 launch robottle launch_nocontroller.launch.py ;
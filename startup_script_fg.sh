@@ -7,6 +7,9 @@ colcon build
 
 # . /home/arthur/dev/ros/workspace1/install/setup.sh
 
+# bigger DDS socket buffers (see robottle/config/fastrtps_profiles.xml)
+export FASTRTPS_DEFAULT_PROFILES_FILE=$(ros2 pkg prefix robottle)/share/robottle/config/fastrtps_profiles.xml
+
 # launch all the nodes
 # ros2 run robottle teleop & 
 ros2 launch ros_deep_learning detectnet.ros2.launch input:=csi://0 output:=display://0 & ros2 launch robottle launch_nocontroller.launch.py & ros2 run robottle controller1 --search; fg